@@ -2,6 +2,15 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import io
+import os
+import re
+import time
+import shutil
+import json
+import hashlib
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuración de la Página ---
 st.set_page_config(
@@ -20,13 +29,17 @@ def format_currency(value):
     except (ValueError, TypeError):
         return "$ 0"
 
+def format_currency_series(series):
+    """Versión vectorizada de format_currency para una columna completa."""
+    formatted = series.fillna(0).astype('int64').map('{:,}'.format)
+    return '$ ' + formatted.str.replace(',', '.', regex=False)
+
 @st.cache_data
 def convert_df_to_csv(df):
     """Convierte un DataFrame a CSV para descarga."""
-    output = io.BytesIO()
-    # Usar utf-8-sig para asegurar compatibilidad con Excel
-    df.to_csv(output, index=False, encoding='utf-8-sig')
-    return output.getvalue()
+    # BOM (equivalente a utf-8-sig) para asegurar compatibilidad con Excel;
+    # se codifica el texto directamente, sin copiar a través de un BytesIO
+    return ('\ufeff' + df.to_csv(index=False)).encode('utf-8')
 
 
 # --- Funciones de Carga y Procesamiento de Datos ---
@@ -37,60 +50,154 @@ REQUIRED_SHEETS_MAPPING = {
     'hoja 3': 'COMENTARIOS',
     'hoja 4': 'NOMINA'
 }
+REQUIRED_SHEET_NAMES = set(REQUIRED_SHEETS_MAPPING.values())
 MIN_MONTHLY_SHEET = 7  # Hoja 7 en adelante (índice 6 en Python)
 
-def find_column(df, patterns):
-    """Encuentra la primera columna que coincida con una lista de patrones."""
-    for col in df.columns:
-        col_upper = str(col).upper()
-        for pattern in patterns:
-            if pattern in col_upper:
-                return col
+def open_excel(source):
+    """
+    Abre el libro con el motor calamine (python-calamine, mucho más rápido
+    que openpyxl). Si no está disponible, usa el motor por defecto de pandas.
+    """
+    try:
+        return pd.ExcelFile(source, engine="calamine")
+    except (ImportError, ValueError):
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return pd.ExcelFile(source)
+
+@lru_cache(maxsize=None)
+def _compile_patterns(patterns):
+    """Compila una tupla de patrones en una sola expresión regular."""
+    return re.compile('|'.join(map(re.escape, patterns)))
+
+def upper_columns(df):
+    """Nombres de columna en mayúsculas, para reutilizar entre búsquedas."""
+    return [str(col).upper() for col in df.columns]
+
+def find_column(df, patterns, upper_cols=None):
+    """
+    Encuentra la primera columna que coincida con una lista de patrones.
+    upper_cols permite pasar upper_columns(df) ya calculado.
+    """
+    if upper_cols is None:
+        upper_cols = upper_columns(df)
+    regex = _compile_patterns(tuple(patterns))
+    for col, col_upper in zip(df.columns, upper_cols):
+        if regex.search(col_upper):
+            return col
     return None
 
-@st.cache_data
-def load_data(uploaded_file):
+def _is_he_column(col):
+    """Indica si una columna corresponde a una clasificación de horas extras."""
+    col_upper = str(col).upper()
+    return 'HORA EXTRA' in col_upper or 'RECARGO' in col_upper
+
+def _usecols_matching(pattern_groups):
+    """
+    usecols para read_excel: parsea solo las columnas que coinciden con algún
+    patrón (la primera coincidencia de find_column siempre queda incluida).
     """
-    Carga y procesa el archivo Excel, replicando la lógica de parseo de JS.
+    regex = _compile_patterns(tuple(pattern for group in pattern_groups for pattern in group))
+    return lambda col: regex.search(str(col).upper()) is not None
+
+def _read_he_sheet(file_bytes, sheet_name):
+    """
+    Lee una hoja mensual de horas extras como CEDULA, clasificaciones y MES.
+    Abre su propio ExcelFile porque los lectores de Excel no son seguros entre hilos.
+    Retorna None si la hoja no tiene Cédula o columnas de horas.
+    """
+    with open_excel(io.BytesIO(file_bytes)) as xls:
+        # Lectura completa: la regla de posición de las clasificaciones necesita todas las columnas
+        df_month = pd.read_excel(xls, sheet_name=sheet_name, dtype=str)
+    
+    id_col_he = find_column(df_month, ['CÉDULA', 'ID'])
+    # Lógica JS: las clasificaciones empiezan en la tercera columna
+    he_cols = [
+        col for i, col in enumerate(df_month.columns)
+        if i > 1 and col != id_col_he and _is_he_column(col)
+    ]
+    if not id_col_he or not he_cols:
+        return None # Omitir hoja si no tiene Cédula o columnas de horas
+    
+    # assign crea un DataFrame nuevo: sin asignar sobre un subconjunto de columnas
+    return (
+        df_month[[id_col_he] + he_cols]
+        .rename(columns={id_col_he: 'CEDULA'})
+        .assign(MES=sheet_name.strip())
+    )
+
+def to_arrow_strings(df):
+    """
+    Convierte (in situ) las columnas de texto a string[pyarrow]: un buffer
+    contiguo en lugar de objetos str de Python.
+    """
+    for col in df.columns:
+        dtype = df[col].dtype
+        if dtype == object or (isinstance(dtype, pd.StringDtype) and dtype != 'string[pyarrow]'):
+            df[col] = df[col].astype('string[pyarrow]')
+
+def contactos_por_cedula(df_empleados):
+    """Nombre y teléfono de cada empleado, indexados por Cédula (una fila por Cédula)."""
+    contact_cols = [col for col in ['NOMBRE', 'TELEFONO'] if col in df_empleados.columns]
+    return df_empleados.drop_duplicates('CEDULA').set_index('CEDULA')[contact_cols]
+
+def parse_workbook(file_bytes):
+    """
+    Carga y procesa las hojas principales del archivo Excel (INFORMACION,
+    COMENTARIOS y NOMINA), replicando la lógica de parseo de JS.
     """
     try:
-        xls = pd.ExcelFile(uploaded_file)
+        # read_excel hereda el motor del ExcelFile (calamine u openpyxl)
+        xls = open_excel(io.BytesIO(file_bytes))
         sheet_names = xls.sheet_names
         normalized_sheet_names = [name.strip().upper() for name in sheet_names]
         
+        # Nombre normalizado -> nombre original (la primera hoja si se repite)
+        norm_to_original = {}
+        for name, normalized_name in zip(sheet_names, normalized_sheet_names):
+            norm_to_original.setdefault(normalized_name, name)
+        
         # --- 1. Encontrar y Parsear Hojas Requeridas ---
         sheet_name_map = {}
         for key, name in REQUIRED_SHEETS_MAPPING.items():
             try:
-                sheet_name_map[key] = sheet_names[normalized_sheet_names.index(name)]
-            except ValueError:
+                sheet_name_map[key] = norm_to_original[name]
+            except KeyError:
                 st.error(f"No se encontró la hoja requerida: '{name}' ({key}).")
                 return None
         
         # Leer hojas principales (dtype=str para proteger Cédulas)
+        # Hoja 1 se lee completa: el detalle del empleado muestra todas sus columnas
         df_empleados = pd.read_excel(xls, sheet_name=sheet_name_map['hoja 1'], dtype=str)
-        df_comentarios = pd.read_excel(xls, sheet_name=sheet_name_map['hoja 3'], dtype=str)
-        df_nomina = pd.read_excel(xls, sheet_name=sheet_name_map['hoja 4'], dtype=str)
-
-        # --- 2. Parsear Horas Extras (Hojas 7+) ---
-        df_horas_extras_list = []
-        he_sheet_names = []
-        for i, sheet_name in enumerate(sheet_names):
-            normalized_name = normalized_sheet_names[i]
-            # Lógica JS: No es una hoja requerida, contiene '2025', está en/después de la hoja 7
-            if (normalized_name not in REQUIRED_SHEETS_MAPPING.values() and 
-                "2025" in normalized_name and  
-                i >= MIN_MONTHLY_SHEET - 1):
-                
-                df_month = pd.read_excel(xls, sheet_name=sheet_name, dtype=str)
-                df_month['MES'] = sheet_name.strip()
-                df_horas_extras_list.append(df_month)
-                he_sheet_names.append(sheet_name.strip())
         
+        # Hojas 3 y 4: una sola lectura que parsea solo las columnas usadas
+        df_comentarios = pd.read_excel(
+            xls, sheet_name=sheet_name_map['hoja 3'], dtype=str,
+            usecols=_usecols_matching([
+                ['CÉDULA', 'ID'],
+                ['COMENTARIOS', 'OBSERVACIONES']
+            ])
+        )
+        df_nomina = pd.read_excel(
+            xls, sheet_name=sheet_name_map['hoja 4'], dtype=str,
+            usecols=_usecols_matching([
+                ['CÉDULA', 'ID'],
+                ['SALARIO BASE'],
+                ['CONTRIBUCIONES EMPLEADOR', 'CONTRIBUCIONES DEL EMPLEADOR'],
+                ['CONTRIBUCIONES EMPLEADO', 'CONTRIBUCIONES DEL EMPLEADO'],
+                ['APORTE ARL'],
+                ['SALARIO REAL'],
+                ['SALARIO BRUTO'],
+                ['HORAS EXTRA'],
+                ['TOTAL A PAGAR AL EMPLEADO']
+            ])
+        )
+
         # --- 3. Procesar y Limpiar df_empleados (Hoja 1) ---
-        id_col_emp = find_column(df_empleados, ['CÉDULA', 'ID', 'NÚMERO DE CONTACTO'])
-        name_col_emp = find_column(df_empleados, ['NOMBRE', 'TÉCNICO', 'EMPLEADO'])
-        phone_col_emp = find_column(df_empleados, ['TELÉFONO', 'CONTACTO'])
+        upper_emp = upper_columns(df_empleados)
+        id_col_emp = find_column(df_empleados, ['CÉDULA', 'ID', 'NÚMERO DE CONTACTO'], upper_emp)
+        name_col_emp = find_column(df_empleados, ['NOMBRE', 'TÉCNICO', 'EMPLEADO'], upper_emp)
+        phone_col_emp = find_column(df_empleados, ['TELÉFONO', 'CONTACTO'], upper_emp)
         
         if not id_col_emp or not name_col_emp:
             st.error("No se pudieron encontrar 'Cédula' o 'Nombre' en la hoja 'INFORMACION'.")
@@ -104,8 +211,9 @@ def load_data(uploaded_file):
         df_empleados = df_empleados[df_empleados['CEDULA'].notna() & (df_empleados['CEDULA'] != '')]
         
         # --- 4. Procesar df_comentarios (Hoja 3) ---
-        id_col_com = find_column(df_comentarios, ['CÉDULA', 'ID'])
-        comment_col = find_column(df_comentarios, ['COMENTARIOS', 'OBSERVACIONES'])
+        upper_com = upper_columns(df_comentarios)
+        id_col_com = find_column(df_comentarios, ['CÉDULA', 'ID'], upper_com)
+        comment_col = find_column(df_comentarios, ['COMENTARIOS', 'OBSERVACIONES'], upper_com)
         
         df_comentarios = df_comentarios.rename(columns={id_col_com: 'CEDULA', comment_col: 'COMENTARIOS'})
         df_comentarios = df_comentarios[df_comentarios['CEDULA'].notna() & (df_comentarios['CEDULA'] != '')]
@@ -118,15 +226,16 @@ def load_data(uploaded_file):
         df_nomina = df_nomina[df_nomina['CEDULA'].notna() & (df_nomina['CEDULA'] != '')]
         
         # Renombrar y convertir columnas numéricas
+        upper_nom = upper_columns(df_nomina)
         rename_map_nom = {
-            find_column(df_nomina, ['SALARIO BASE']): 'SALARIO_BASE',
-            find_column(df_nomina, ['CONTRIBUCIONES EMPLEADOR', 'CONTRIBUCIONES DEL EMPLEADOR']): 'CONTRIBUCION_EMPR',
-            find_column(df_nomina, ['CONTRIBUCIONES EMPLEADO', 'CONTRIBUCIONES DEL EMPLEADO']): 'CONTRIBUCION_EMPL',
-            find_column(df_nomina, ['APORTE ARL']): 'APORTE_ARL',
-            find_column(df_nomina, ['SALARIO REAL']): 'SALARIO_REAL',
-            find_column(df_nomina, ['SALARIO BRUTO']): 'SALARIO_BRUTO',
-            find_column(df_nomina, ['HORAS EXTRA']): 'HORAS_EXTRA_NOM',
-            find_column(df_nomina, ['TOTAL A PAGAR AL EMPLEADO']): 'TOTAL_PAGAR_NOM'
+            find_column(df_nomina, ['SALARIO BASE'], upper_nom): 'SALARIO_BASE',
+            find_column(df_nomina, ['CONTRIBUCIONES EMPLEADOR', 'CONTRIBUCIONES DEL EMPLEADOR'], upper_nom): 'CONTRIBUCION_EMPR',
+            find_column(df_nomina, ['CONTRIBUCIONES EMPLEADO', 'CONTRIBUCIONES DEL EMPLEADO'], upper_nom): 'CONTRIBUCION_EMPL',
+            find_column(df_nomina, ['APORTE ARL'], upper_nom): 'APORTE_ARL',
+            find_column(df_nomina, ['SALARIO REAL'], upper_nom): 'SALARIO_REAL',
+            find_column(df_nomina, ['SALARIO BRUTO'], upper_nom): 'SALARIO_BRUTO',
+            find_column(df_nomina, ['HORAS EXTRA'], upper_nom): 'HORAS_EXTRA_NOM',
+            find_column(df_nomina, ['TOTAL A PAGAR AL EMPLEADO'], upper_nom): 'TOTAL_PAGAR_NOM'
         }
         
         df_nomina = df_nomina.rename(columns=rename_map_nom)
@@ -137,63 +246,299 @@ def load_data(uploaded_file):
         for col in num_cols:
             if col in df_nomina.columns:
                 # Solo convertir a numérico si la columna fue encontrada y renombrada
-                df_nomina[col] = pd.to_numeric(df_nomina[col], errors='coerce').fillna(0)
+                values = pd.to_numeric(df_nomina[col], errors='coerce').fillna(0)
+                # float32 (mitad de memoria) solo si todos los valores se conservan exactos
+                # (p. ej. 999999.99 pasaría a 1000000.0): si no, se queda en float64
+                values_f32 = values.astype('float32')
+                if (values_f32.astype('float64') == values).all():
+                    values = values_f32
+                df_nomina[col] = values
             
         df_nomina = df_nomina.set_index('CEDULA')
+        # Una fila por Cédula (la última, igual que el lookup de salarios).
+        # Las filas descartadas se informan al usuario desde main
+        duplicated_nom = df_nomina.index.duplicated(keep='last')
+        df_nomina = df_nomina[~duplicated_nom]
         
         # --- 6. Combinar Datos (Replicar lógica JS) ---
         # Añadir 'TOTAL_PAGAR_NOM' y 'HORAS_EXTRA_NOM' de Nómina a Comentarios
-        df_comentarios = df_comentarios.join(df_nomina[['HORAS_EXTRA_NOM', 'TOTAL_PAGAR_NOM']], how='left')
-        df_comentarios['HORAS_EXTRA_NOM'].fillna(0, inplace=True)
-        df_comentarios['TOTAL_PAGAR_NOM'].fillna(0, inplace=True)
+        df_comentarios = df_comentarios.join(
+            df_nomina[['HORAS_EXTRA_NOM', 'TOTAL_PAGAR_NOM']], how='left', validate='m:1'
+        )
+        df_comentarios = df_comentarios.fillna({'HORAS_EXTRA_NOM': 0, 'TOTAL_PAGAR_NOM': 0})
+        
+        # Datos de contacto por Cédula (una fila por empleado)
+        contactos = contactos_por_cedula(df_empleados)
+        nombres_por_cedula = contactos['NOMBRE']
+        
+        # Añadir nombre y teléfono a Comentarios
+        df_comentarios = df_comentarios.join(contactos, how='left', validate='m:1')
+        
+        # Añadir el nombre del empleado a Nómina (la Cédula si no hay nombre)
+        df_nomina = df_nomina.join(nombres_por_cedula, how='left', validate='1:1')
+        df_nomina['NOMBRE'] = df_nomina['NOMBRE'].where(df_nomina['NOMBRE'].notna(), df_nomina.index.to_numpy())
+        
+        # Nombres en minúscula precalculados para las búsquedas de la UI
+        df_empleados['NOMBRE_LOWER'] = df_empleados['NOMBRE'].str.lower()
+        df_nomina['NOMBRE_LOWER'] = df_nomina['NOMBRE'].str.lower()
+
+        return {
+            "empleados": df_empleados.reset_index(drop=True), # Resetear índice para filtros
+            "comentarios": df_comentarios.reset_index(),
+            "nomina": df_nomina.reset_index(),
+            "nomina_duplicadas": int(duplicated_nom.sum())
+        }
 
+    except Exception as e:
+        st.error(f"Error crítico al procesar el archivo: {e}")
+        return None
+
+def parse_horas_extras(file_bytes, nombres_por_cedula):
+    """
+    Carga y procesa las hojas mensuales de Horas Extras (hoja 7 en adelante),
+    uniendo el nombre de cada empleado desde nombres_por_cedula.
+    """
+    try:
+        with open_excel(io.BytesIO(file_bytes)) as xls:
+            sheet_names = xls.sheet_names
+        
+        # --- 2. Parsear Horas Extras (Hojas 7+) ---
+        he_sheets = []
+        for i, sheet_name in enumerate(sheet_names):
+            normalized_name = sheet_name.strip().upper()
+            # Lógica JS: No es una hoja requerida, contiene '2025', está en/después de la hoja 7
+            if (normalized_name not in REQUIRED_SHEET_NAMES and 
+                "2025" in normalized_name and  
+                i >= MIN_MONTHLY_SHEET - 1):
+                he_sheets.append(sheet_name)
+        he_sheet_names = [sheet_name.strip() for sheet_name in he_sheets]
+        
+        # Leer las hojas mensuales en paralelo (map conserva el orden de las hojas)
+        df_horas_extras_list = []
+        if he_sheets:
+            with ThreadPoolExecutor(max_workers=min(8, len(he_sheets))) as executor:
+                results = executor.map(lambda sheet_name: _read_he_sheet(file_bytes, sheet_name), he_sheets)
+                df_horas_extras_list = [df_month for df_month in results if df_month is not None]
+        
         # --- 7. Procesar Horas Extras (Pandas Melt) ---
         df_he_processed = pd.DataFrame()
         if df_horas_extras_list:
-            processed_dfs = []
-            for df_month in df_horas_extras_list:
-                id_col_he = find_column(df_month, ['CÉDULA', 'ID'])
-                if not id_col_he:
-                    continue # Omitir hoja si no tiene Cédula
-
-                # Encontrar columnas de clasificación (basado en lógica JS)
-                classification_cols = []
-                for i, col in enumerate(df_month.columns):
-                    if i > 1 and ('HORA EXTRA' in str(col).upper() or 'RECARGO' in str(col).upper()):
-                        classification_cols.append(col)
-                
-                if not classification_cols:
-                    continue # Omitir si no hay columnas de horas
-                    
-                # "Derretir" (melt) la tabla a formato largo
-                df_melted = df_month.melt(
-                    id_vars=[id_col_he, 'MES'],
-                    value_vars=classification_cols,
-                    var_name='CLASIFICACION',
-                    value_name='HORAS'
-                )
-                
-                df_melted = df_melted.rename(columns={id_col_he: 'CEDULA'})
-                df_melted['HORAS'] = pd.to_numeric(df_melted['HORAS'], errors='coerce').fillna(0)
-                df_melted = df_melted[df_melted['HORAS'] > 0] # Mantener solo registros con horas
-                processed_dfs.append(df_melted)
-
-            if processed_dfs:
-                df_he_processed = pd.concat(processed_dfs, ignore_index=True)
-                df_he_processed = df_he_processed[df_he_processed['CEDULA'].notna() & (df_he_processed['CEDULA'] != '')]
+            # Cada hoja ya viene como CEDULA + clasificaciones + MES; el melt se hace una sola vez.
+            # Las clasificaciones ausentes en un mes quedan en NaN y se descartan abajo
+            df_wide = pd.concat(df_horas_extras_list, join='outer', ignore_index=True, sort=False)
+            
+            # "Derretir" (melt) la tabla a formato largo
+            df_he_processed = df_wide.melt(
+                id_vars=['CEDULA', 'MES'],
+                var_name='CLASIFICACION',
+                value_name='HORAS'
+            )
+            df_he_processed['HORAS'] = pd.to_numeric(df_he_processed['HORAS'], errors='coerce').fillna(0).astype('float32')
+            df_he_processed = df_he_processed[df_he_processed['HORAS'] > 0] # Mantener solo registros con horas
+            df_he_processed = df_he_processed[df_he_processed['CEDULA'].notna() & (df_he_processed['CEDULA'] != '')]
+            
+            # Unir nombres de empleados
+            df_he_processed = df_he_processed.join(nombres_por_cedula, on='CEDULA', how='left', validate='m:1')
+            df_he_processed['NOMBRE'] = df_he_processed['NOMBRE'].fillna(df_he_processed['CEDULA']) # Usar Cédula si no hay nombre
+            
+            # Columnas muy repetidas como categorías (menos memoria, groupby más rápido)
+            for col in ['NOMBRE', 'CLASIFICACION', 'MES', 'CEDULA']:
+                df_he_processed[col] = df_he_processed[col].astype('category')
 
         return {
-            "empleados": df_empleados.reset_index(drop=True), # Resetear índice para filtros
-            "comentarios": df_comentarios.reset_index(),
-            "nomina": df_nomina.reset_index(),
             "horas_extras": df_he_processed,
             "he_sheet_names": he_sheet_names
         }
 
     except Exception as e:
-        st.error(f"Error crítico al procesar el archivo: {e}")
+        st.error(f"Error crítico al procesar las Horas Extras: {e}")
+        return None
+
+# --- Caché Persistente (Parquet) ---
+
+# Directorio de la caché en disco; la versión invalida entradas de formatos anteriores.
+# Contiene datos de nómina: las entradas sin uso se borran tras CACHE_MAX_AGE_DAYS días.
+CACHE_DIR = Path(os.environ.get("SICET_CACHE_DIR", ".cache/libros"))
+CACHE_VERSION = 11
+
+def _env_float(name, default):
+    """Lee un número de una variable de entorno; usa el valor por defecto si no es válido."""
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+CACHE_MAX_AGE_DAYS = _env_float("SICET_CACHE_MAX_AGE_DAYS", 7)
+CORE_FRAMES = ("empleados", "comentarios", "nomina")
+HE_FRAMES = ("horas_extras",)
+
+def _cache_path(file_bytes):
+    """Ruta de la caché para un libro, según el hash de su contenido."""
+    key = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    return CACHE_DIR / f"v{CACHE_VERSION}" / key
+
+@st.cache_resource(ttl=3600)
+def prune_cache():
+    """
+    Borra los directorios de versiones anteriores de la caché y las entradas
+    sin uso en los últimos CACHE_MAX_AGE_DAYS días (como máximo una vez por hora).
+    """
+    if not CACHE_DIR.is_dir():
+        return
+    current_dir = CACHE_DIR / f"v{CACHE_VERSION}"
+    cutoff = time.time() - CACHE_MAX_AGE_DAYS * 24 * 3600
+    for path in CACHE_DIR.iterdir():
+        # Solo directorios de versión (v1, v2, ...): SICET_CACHE_DIR puede contener otras cosas
+        if path.is_dir() and re.fullmatch(r'v\d+', path.name) and path != current_dir:
+            shutil.rmtree(path, ignore_errors=True)
+    if current_dir.is_dir():
+        for entry in current_dir.iterdir():
+            if entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry, ignore_errors=True)
+
+def read_cached_frames(cache_path, frames, meta_name):
+    """Lee DataFrames ya procesados y su meta. Retorna None si no están en caché."""
+    meta_file = cache_path / meta_name
+    if not meta_file.exists():
+        return None
+    try:
+        data = {name: pd.read_parquet(cache_path / f"{name}.parquet") for name in frames}
+        data.update(json.loads(meta_file.read_text(encoding="utf-8")))
+        # Marcar la entrada como usada para que prune_cache no la borre
+        os.utime(cache_path)
+        return data
+    except Exception:
+        # Entrada corrupta o ilegible: se vuelve a procesar el Excel
         return None
 
+def write_cached_frames(cache_path, data, frames, meta_name, meta_keys=()):
+    """Persiste DataFrames procesados en Parquet (zstd) junto a su meta."""
+    try:
+        cache_path.mkdir(parents=True, exist_ok=True)
+        for name in frames:
+            data[name].to_parquet(
+                cache_path / f"{name}.parquet", engine="pyarrow", compression="zstd"
+            )
+        # La meta se escribe al final: su existencia marca la entrada como completa
+        meta = {key: data[key] for key in meta_keys}
+        (cache_path / meta_name).write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    except Exception:
+        # La caché es opcional (p. ej. encabezados no textuales o disco de solo lectura)
+        pass
+
+@st.cache_data
+def load_data(uploaded_file):
+    """
+    Retorna los datos procesados de las hojas principales. Busca primero en la
+    caché Parquet (por hash del contenido) y solo parsea el Excel si no existe.
+    """
+    file_bytes = uploaded_file.getvalue()
+    cache_path = _cache_path(file_bytes)
+    data = read_cached_frames(cache_path, CORE_FRAMES, "meta.json")
+    if data is None:
+        data = parse_workbook(file_bytes)
+        if data is None:
+            return None
+        write_cached_frames(cache_path, data, CORE_FRAMES, "meta.json", ["nomina_duplicadas"])
+    
+    # Texto como string[pyarrow] tanto al parsear como al leer de la caché
+    # (read_parquet puede devolverlo como string[python] u object)
+    for name in CORE_FRAMES:
+        to_arrow_strings(data[name])
+    
+    # Versión indexada por Cédula para los lookups de la UI (una vez por libro)
+    data["nomina_by_cedula"] = data["nomina"].set_index('CEDULA')
+    return data
+
+@st.cache_data
+def load_horas_extras(uploaded_file):
+    """
+    Retorna las Horas Extras procesadas. Se carga aparte de load_data para
+    parsear las hojas mensuales solo cuando se abre esa sección.
+    """
+    file_bytes = uploaded_file.getvalue()
+    cache_path = _cache_path(file_bytes)
+    data = read_cached_frames(cache_path, HE_FRAMES, "he_meta.json")
+    if data is None:
+        core_data = load_data(uploaded_file)
+        if core_data is None:
+            return None
+        nombres_por_cedula = contactos_por_cedula(core_data['empleados'])['NOMBRE']
+        data = parse_horas_extras(file_bytes, nombres_por_cedula)
+        if data is None:
+            return None
+        write_cached_frames(cache_path, data, HE_FRAMES, "he_meta.json", ["he_sheet_names"])
+    return data
+
+# --- Agregaciones para la UI (cacheadas entre re-ejecuciones) ---
+
+@st.cache_data
+def he_aggregates(df_he):
+    """
+    Cubo de horas extras (mes, empleado, clasificación) y sus totales por
+    clasificación, por empleado y por mes/empleado.
+    """
+    # Un solo recorrido de df_he al nivel más fino; el resto se deriva del cubo
+    # HORAS se guarda en float32: acumular en float64 para que los totales no se desvíen
+    horas = df_he['HORAS'].astype('float64')
+    cube = horas.groupby([df_he['MES'], df_he['NOMBRE'], df_he['CLASIFICACION']], observed=True).sum()
+    return (
+        cube,
+        cube.groupby(level='CLASIFICACION', observed=True).sum(),
+        cube.groupby(level='NOMBRE', observed=True).sum(),
+        cube.groupby(level=['MES', 'NOMBRE'], observed=True).sum()
+    )
+
+@st.cache_data
+def he_pivot(cube, month):
+    """Tabla de horas por empleado y clasificación, con totales, para un mes."""
+    if month == "Total General":
+        table_data = cube.groupby(level=['NOMBRE', 'CLASIFICACION'], observed=True).sum()
+    elif month in cube.index.get_level_values('MES'):
+        table_data = cube.xs(month, level='MES')
+    else:
+        return pd.DataFrame()
+    
+    # Pivotear el cubo ya agregado (no el formato largo completo)
+    pivot = table_data.unstack('CLASIFICACION', fill_value=0)
+    pivot.index = pivot.index.astype(object)
+    pivot.columns = pivot.columns.astype(object)
+    
+    # Fila y columna de Total (mismo resultado que pivot_table con margins=True)
+    pivot['TOTAL GENERAL'] = pivot.sum(axis=1)
+    pivot.loc['TOTAL GENERAL'] = pivot.sum(axis=0)
+    return pivot
+
+@st.cache_data
+def build_he_figs(by_clasif, by_name, by_month_name):
+    """Gráficos de horas extras a partir de los totales de he_aggregates."""
+    # Gráfico 1: Por Clasificación (Doughnut)
+    df_chart1 = by_clasif.reset_index()
+    fig1 = px.pie(df_chart1, names='CLASIFICACION', values='HORAS', 
+                  title="Horas Extras por Clasificación (Total)")
+    
+    # Gráfico 2: Por Empleado (Bar)
+    df_chart2 = by_name.reset_index()
+    fig2 = px.bar(df_chart2, x='NOMBRE', y='HORAS', 
+                  title="Horas Extras Totales por Empleado (Comparación)")
+    
+    # Gráfico 3: Por Mes (Line)
+    df_chart3 = by_month_name.reset_index()
+    fig3 = px.line(df_chart3, x='MES', y='HORAS', color='NOMBRE', 
+                   title="Horas Extras por Mes y Empleado (Comparación Temporal)")
+    return fig1, fig2, fig3
+
+@st.cache_data
+def nomina_totals(df_nomina):
+    """Suma de cada concepto de nómina (0 si la columna no existe)."""
+    concepts = ['SALARIO_REAL', 'SALARIO_BRUTO', 'CONTRIBUCION_EMPR',
+                'CONTRIBUCION_EMPL', 'APORTE_ARL', 'SALARIO_BASE']
+    return {
+        # Las columnas pueden ser float32: sumar en float64 para no perder pesos
+        col: df_nomina[col].astype('float64').sum() if col in df_nomina.columns else 0
+        for col in concepts
+    }
+
 # --- Funciones de UI por Sección ---
 
 def show_empleados(df_empleados, df_nomina_lookup):
@@ -206,8 +551,8 @@ def show_empleados(df_empleados, df_nomina_lookup):
     if search_query:
         query = search_query.lower()
         df_filtered = df_empleados[
-            df_empleados['NOMBRE'].str.lower().str.contains(query) |
-            df_empleados['CEDULA'].str.contains(query)
+            df_empleados['NOMBRE_LOWER'].str.contains(query, regex=False, na=False) |
+            df_empleados['CEDULA'].str.contains(query, regex=False, na=False)
         ]
         
     if df_filtered.empty:
@@ -218,16 +563,22 @@ def show_empleados(df_empleados, df_nomina_lookup):
     cols = st.columns(3)
     col_idx = 0
     
-    for _, emp in df_filtered.iterrows():
-        cedula = emp['CEDULA']
-        nombre = emp['NOMBRE']
-        
-        # Buscar datos de nómina
-        nomina_data = df_nomina_lookup.loc[cedula] if cedula in df_nomina_lookup.index else pd.Series()
-        
-        # --- Verificación de seguridad ---
-        salario_real = nomina_data.get('SALARIO_REAL', 0)
-        telefono = emp.get('TELEFONO', 'N/A')
+    # Columnas de la Hoja 1 para el detalle (sin columnas auxiliares)
+    emp_columns = [col for col in df_filtered.columns if col != 'NOMBRE_LOWER']
+    detail_positions = [df_filtered.columns.get_loc(col) for col in emp_columns]
+    
+    # Salarios de nómina como dict: una sola búsqueda por tarjeta
+    # --- Verificación de seguridad ---
+    salario_map = (
+        df_nomina_lookup['SALARIO_REAL'].to_dict()
+        if 'SALARIO_REAL' in df_nomina_lookup.columns else {}
+    )
+    
+    for emp in df_filtered.itertuples(index=False):
+        cedula = emp.CEDULA
+        nombre = emp.NOMBRE
+        salario_real = salario_map.get(cedula, 0)
+        telefono = getattr(emp, 'TELEFONO', 'N/A')
         
         with cols[col_idx]:
             with st.container(border=True):
@@ -240,17 +591,18 @@ def show_empleados(df_empleados, df_nomina_lookup):
                 with st.popover("Ver Detalle Completo", use_container_width=True):
                     st.subheader(nombre)
                     # Mostrar *todos* los datos de la Hoja 1 para este empleado
-                    detalle_df = emp.to_frame(name="Valor")
-                    detalle_df.index.name = "Campo"
+                    detalle_df = pd.DataFrame(
+                        {"Valor": [emp[i] for i in detail_positions]},
+                        index=pd.Index(emp_columns, name="Campo")
+                    )
                     st.dataframe(detalle_df, use_container_width=True)
         
         col_idx = (col_idx + 1) % 3
 
-def show_comentarios(df_comentarios, df_empleados_master):
+def show_comentarios(df_comentarios):
     st.header("💬 Comentarios y Observaciones")
     
-    # Unir con nombres de empleados
-    df_comentarios = df_comentarios.join(df_empleados_master[['NOMBRE', 'TELEFONO']], on='CEDULA', how='left')
+    # (Nombre y teléfono ya vienen unidos desde load_data)
     
     # 1. Métrica Total
     st.metric("Total General de Comentarios Registrados", len(df_comentarios))
@@ -274,14 +626,14 @@ def show_comentarios(df_comentarios, df_empleados_master):
         return
 
     # 4. "Tarjetas" de Comentarios
-    for _, item in df_filtered.iterrows():
-        with st.container(border=True, key=item['CEDULA']):
-            st.subheader(f"{item.get('NOMBRE', 'N/A')} ({item['CEDULA']})")
+    for item in df_filtered.itertuples(index=False):
+        with st.container(border=True, key=item.CEDULA):
+            st.subheader(f"{getattr(item, 'NOMBRE', 'N/A')} ({item.CEDULA})")
             
             cols = st.columns(2)
-            cols[0].text(f"Teléfono: {item.get('TELEFONO', 'N/A')}")
+            cols[0].text(f"Teléfono: {getattr(item, 'TELEFONO', 'N/A')}")
             # --- Verificación de seguridad ---
-            cols[1].text(f"Total a Pagar: {format_currency(item.get('TOTAL_PAGAR_NOM', 0))}")
+            cols[1].text(f"Total a Pagar: {format_currency(getattr(item, 'TOTAL_PAGAR_NOM', 0))}")
             
             st.divider()
             
@@ -289,28 +641,27 @@ def show_comentarios(df_comentarios, df_empleados_master):
             # Añadir una 'key' única para cada text_area
             st.text_area(
                 "Comentarios:", 
-                value=item.get('COMENTARIOS', 'N/A'), 
+                value=getattr(item, 'COMENTARIOS', 'N/A'), 
                 disabled=True, 
                 height=100,
-                key=f"comment_area_{item['CEDULA']}" # Llave única
+                key=f"comment_area_{item.CEDULA}" # Llave única
             )
             # --- FIN DE LA CORRECCIÓN ---
             
-def show_horas_extras(df_he, df_empleados_master, he_sheet_names):
+def show_horas_extras(df_he, he_sheet_names):
     st.header("⏳ Análisis de Horas Extras")
 
     if df_he.empty:
         st.warning("No se encontraron datos de Horas Extras para analizar.")
         return
 
-    # 1. Unir nombres de empleados
-    df_he = df_he.join(df_empleados_master['NOMBRE'], on='CEDULA', how='left')
-    df_he['NOMBRE'] = df_he['NOMBRE'].fillna(df_he['CEDULA']) # Usar Cédula si no hay nombre
+    # 1. Agregados (los nombres de empleados ya vienen unidos desde load_data)
+    cube, by_clasif, by_name, by_month_name = he_aggregates(df_he)
     
     # 2. Tarjetas de Resumen
-    total_general_hours = df_he['HORAS'].sum()
-    total_clasificaciones = df_he['CLASIFICACION'].nunique()
-    total_meses = df_he['MES'].nunique()
+    total_general_hours = by_clasif.sum()
+    total_clasificaciones = len(by_clasif)
+    total_meses = by_month_name.index.get_level_values('MES').nunique()
     
     cols_metrics = st.columns(3)
     cols_metrics[0].metric("Total General de Horas Extras", f"{total_general_hours:.2f} hrs")
@@ -319,7 +670,7 @@ def show_horas_extras(df_he, df_empleados_master, he_sheet_names):
     
     # 3. Top 3 Empleados
     with st.expander("🏆 Top 3 Empleados con Más Horas Extras", expanded=True):
-        df_top_emp = df_he.groupby('NOMBRE')['HORAS'].sum().nlargest(3).reset_index()
+        df_top_emp = by_name.nlargest(3).reset_index()
         df_top_emp.index = ['🥇', '🥈', '🥉'][:len(df_top_emp)] # Añadir emojis
         st.dataframe(
             df_top_emp.style.format({'HORAS': '{:.2f} hrs'}),
@@ -332,20 +683,7 @@ def show_horas_extras(df_he, df_empleados_master, he_sheet_names):
     st.subheader("Gráficos de Horas Extras")
     
     try:
-        # Gráfico 1: Por Clasificación (Doughnut)
-        df_chart1 = df_he.groupby('CLASIFICACION')['HORAS'].sum().reset_index()
-        fig1 = px.pie(df_chart1, names='CLASIFICACION', values='HORAS', 
-                      title="Horas Extras por Clasificación (Total)")
-        
-        # Gráfico 2: Por Empleado (Bar)
-        df_chart2 = df_he.groupby('NOMBRE')['HORAS'].sum().reset_index()
-        fig2 = px.bar(df_chart2, x='NOMBRE', y='HORAS', 
-                      title="Horas Extras Totales por Empleado (Comparación)")
-        
-        # Gráfico 3: Por Mes (Line)
-        df_chart3 = df_he.groupby(['MES', 'NOMBRE'])['HORAS'].sum().reset_index()
-        fig3 = px.line(df_chart3, x='MES', y='HORAS', color='NOMBRE', 
-                       title="Horas Extras por Mes y Empleado (Comparación Temporal)")
+        fig1, fig2, fig3 = build_he_figs(by_clasif, by_name, by_month_name)
         
         # Mostrar gráficos
         cols_charts = st.columns(2)
@@ -364,23 +702,9 @@ def show_horas_extras(df_he, df_empleados_master, he_sheet_names):
     month_options = ["Total General"] + he_sheet_names
     selected_month = st.selectbox("Filtrar por Mes:", options=month_options)
     
-    df_table_data = df_he
-    if selected_month != "Total General":
-        df_table_data = df_he[df_he['MES'] == selected_month]
-        
-    if not df_table_data.empty:
-        # Usar pivot_table es la forma "Pythonica" de crear esta tabla
-        pivot = pd.pivot_table(
-            df_table_data,
-            values='HORAS',
-            index='NOMBRE',
-            columns='CLASIFICACION',
-            aggfunc='sum',
-            fill_value=0,
-            margins=True,       # ¡Esto añade la fila y columna de Total automáticamente!
-            margins_name="TOTAL GENERAL"
-        )
+    pivot = he_pivot(cube, selected_month)
         
+    if not pivot.empty:
         # Aplicar estilo para destacar los totales
         st.dataframe(
             pivot.style.format('{:.2f}')
@@ -391,7 +715,7 @@ def show_horas_extras(df_he, df_empleados_master, he_sheet_names):
     else:
         st.info("No hay datos de horas extras para la selección actual.")
 
-def show_nomina(df_nomina, df_empleados_master):
+def show_nomina(df_nomina):
     st.header("💰 Análisis de Nómina")
     
     if df_nomina.empty:
@@ -400,10 +724,11 @@ def show_nomina(df_nomina, df_empleados_master):
 
     # 1. Tarjetas de Resumen
     # Verificar si las columnas existen antes de sumar. Si no, usar 0.
-    total_real = df_nomina['SALARIO_REAL'].sum() if 'SALARIO_REAL' in df_nomina.columns else 0
-    total_bruto = df_nomina['SALARIO_BRUTO'].sum() if 'SALARIO_BRUTO' in df_nomina.columns else 0
-    total_empr = df_nomina['CONTRIBUCION_EMPR'].sum() if 'CONTRIBUCION_EMPR' in df_nomina.columns else 0
-    total_empl = df_nomina['CONTRIBUCION_EMPL'].sum() if 'CONTRIBUCION_EMPL' in df_nomina.columns else 0
+    totals = nomina_totals(df_nomina)
+    total_real = totals['SALARIO_REAL']
+    total_bruto = totals['SALARIO_BRUTO']
+    total_empr = totals['CONTRIBUCION_EMPR']
+    total_empl = totals['CONTRIBUCION_EMPL']
     
     cols_metrics = st.columns(4)
     cols_metrics[0].metric("Total Salario Real (Acumulado)", format_currency(total_real))
@@ -416,18 +741,14 @@ def show_nomina(df_nomina, df_empleados_master):
     # 2. Tabla Detallada con Búsqueda
     st.subheader("Lista Detallada de Nómina")
     
-    # Unir nombres de empleados
-    df_nomina = df_nomina.join(df_empleados_master['NOMBRE'], on='CEDULA', how='left')
-    df_nomina['NOMBRE'] = df_nomina['NOMBRE'].fillna(df_nomina['CEDULA'])
-    
     search_query = st.text_input("Buscar empleado por Nombre o Cédula...", key="nom_search")
     
     df_filtered = df_nomina
     if search_query:
         query = search_query.lower()
         df_filtered = df_nomina[
-            df_nomina['NOMBRE'].str.lower().str.contains(query) |
-            df_nomina['CEDULA'].str.contains(query)
+            df_nomina['NOMBRE_LOWER'].str.contains(query, regex=False, na=False) |
+            df_nomina['CEDULA'].str.contains(query, regex=False, na=False)
         ]
     
     # Preparar DataFrame para mostrar
@@ -443,19 +764,21 @@ def show_nomina(df_nomina, df_empleados_master):
             
     df_display = df_display_safe[display_cols]
     
-    # Aplicar formato de moneda
-    format_dict = {
-        'SALARIO_BASE': format_currency,
-        'CONTRIBUCION_EMPR': format_currency,
-        'CONTRIBUCION_EMPL': format_currency,
-        'APORTE_ARL': format_currency,
-        'SALARIO_BRUTO': format_currency,
-        'SALARIO_REAL': format_currency,
-    }
-    st.dataframe(df_display.style.format(format_dict), use_container_width=True)
+    # Aplicar formato de moneda (por columna, sin Styler)
+    currency_cols = [
+        'SALARIO_BASE', 'CONTRIBUCION_EMPR', 'CONTRIBUCION_EMPL',
+        'APORTE_ARL', 'SALARIO_BRUTO', 'SALARIO_REAL'
+    ]
+    df_display_fmt = df_display.assign(
+        **{col: format_currency_series(df_display[col]) for col in currency_cols}
+    )
+    st.dataframe(df_display_fmt, use_container_width=True)
 
     # 3. Botón de Exportar
-    csv_data = convert_df_to_csv(df_display)
+    # Los montos float32 se exportan como float64 para que to_csv no use notación científica
+    csv_data = convert_df_to_csv(df_display.astype(
+        {col: 'float64' for col in currency_cols if df_display[col].dtype == 'float32'}
+    ))
     st.download_button(
         label="⬇️ Exportar Resumen de Nómina (CSV)",
         data=csv_data,
@@ -470,7 +793,7 @@ def show_nomina(df_nomina, df_empleados_master):
     
     try:
         # Gráfico 1: Distribución Salario Real (Pie)
-        if 'SALARIO_REAL' in df_nomina.columns and df_nomina['SALARIO_REAL'].sum() > 0:
+        if total_real > 0:
             fig1 = px.pie(
                 df_nomina[df_nomina['SALARIO_REAL'] > 0], 
                 names='NOMBRE', 
@@ -483,9 +806,9 @@ def show_nomina(df_nomina, df_empleados_master):
 
         
         # Gráfico 2: Comparativa de Conceptos (Bar)
-        # (Las variables total_empr, total_empl ya se calcularon de forma segura arriba)
-        total_arl = df_nomina['APORTE_ARL'].sum() if 'APORTE_ARL' in df_nomina.columns else 0
-        total_base = df_nomina['SALARIO_BASE'].sum() if 'SALARIO_BASE' in df_nomina.columns else 0
+        # (Los totales ya se calcularon de forma segura arriba con nomina_totals)
+        total_arl = totals['APORTE_ARL']
+        total_base = totals['SALARIO_BASE']
 
         df_chart2 = pd.DataFrame({
             'Concepto': ['Salario Base', 'Contrib. Empleador', 'Contrib. Empleado', 'Aporte ARL'],
@@ -524,11 +847,18 @@ def main():
         st.stop()
         
     # 2. Cargar y cachear datos
+    prune_cache()
     data = load_data(uploaded_file)
     
     if data is None:
         st.error("El archivo no pudo ser procesado. Verifique el formato y las hojas requeridas.")
         st.stop()
+    
+    if data['nomina_duplicadas']:
+        st.warning(
+            f"La hoja 'NOMINA' tiene {data['nomina_duplicadas']} fila(s) con Cédula repetida. "
+            "Se conservó solo la última fila de cada Cédula en totales, tablas y gráficos."
+        )
 
     # 3. Navegación en Sidebar
     st.sidebar.title("Navegación")
@@ -538,22 +868,22 @@ def main():
         captions=["Info y búsqueda", "Observaciones", "Análisis HE", "Análisis de Pago"]
     )
     
-    # --- Pre-procesar datos para UI (crear lookups) ---
-    df_empleados_master = data['empleados'].set_index('CEDULA')
-    df_nomina_lookup = data['nomina'].set_index('CEDULA')
-    
     # 4. Enrutamiento de Secciones
     if section == "👥 Empleados":
-        show_empleados(data['empleados'], df_nomina_lookup)
+        # Lookup por Cédula (ya indexado y cacheado por load_data)
+        show_empleados(data['empleados'], data['nomina_by_cedula'])
         
     elif section == "💬 Comentarios":
-        show_comentarios(data['comentarios'], df_empleados_master)
+        show_comentarios(data['comentarios'])
         
     elif section == "⏳ Horas Extras":
-        show_horas_extras(data['horas_extras'], df_empleados_master, data['he_sheet_names'])
+        # Las hojas mensuales solo se parsean al abrir esta sección
+        he_data = load_horas_extras(uploaded_file)
+        if he_data is not None:
+            show_horas_extras(he_data['horas_extras'], he_data['he_sheet_names'])
         
     elif section == "💰 Nómina":
-        show_nomina(data['nomina'], df_empleados_master)
+        show_nomina(data['nomina'])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file